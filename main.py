@@ -8,52 +8,49 @@ import re
 import sys
 
 from xml.etree import ElementTree
-from collections import Counter, OrderedDict
-
-from icalendar import Calendar, Event
-from datetime import datetime
-from pytz import UTC   # timezone
+from collections import Counter
+from functools import lru_cache
 
 __version__ = '1.3'
 
-RECORD_FIELDS = OrderedDict((
-    ('sourceName', 's'),
-    ('sourceVersion', 's'),
-    ('device', 's'),
-    ('type', 's'),
-    ('unit', 's'),
-    ('creationDate', 'd'),
-    ('startDate', 'd'),
-    ('endDate', 'd'),
-    ('value', 'n'),
-))
-
-ACTIVITY_SUMMARY_FIELDS = OrderedDict((
-    ('dateComponents', 'd'),
-    ('activeEnergyBurned', 'n'),
-    ('activeEnergyBurnedGoal', 'n'),
-    ('activeEnergyBurnedUnit', 's'),
-    ('appleExerciseTime', 's'),
-    ('appleExerciseTimeGoal', 's'),
-    ('appleStandHours', 'n'),
-    ('appleStandHoursGoal', 'n'),
-))
-
-WORKOUT_FIELDS = OrderedDict((
-    ('sourceName', 's'),
-    ('sourceVersion', 's'),
-    ('device', 's'),
-    ('creationDate', 'd'),
-    ('startDate', 'd'),
-    ('endDate', 'd'),
-    ('workoutActivityType', 's'),
-    ('duration', 'n'),
-    ('durationUnit', 's'),
-    ('totalDistance', 'n'),
-    ('totalDistanceUnit', 's'),
-    ('totalEnergyBurned', 'n'),
-    ('totalEnergyBurnedUnit', 's'),
-))
+RECORD_FIELDS = {
+    'sourceName': 's',
+    'sourceVersion': 's',
+    'device': 's',
+    'type': 's',
+    'unit': 's',
+    'creationDate': 'd',
+    'startDate': 'd',
+    'endDate': 'd',
+    'value': 'n',
+}
+
+ACTIVITY_SUMMARY_FIELDS = {
+    'dateComponents': 'd',
+    'activeEnergyBurned': 'n',
+    'activeEnergyBurnedGoal': 'n',
+    'activeEnergyBurnedUnit': 's',
+    'appleExerciseTime': 's',
+    'appleExerciseTimeGoal': 's',
+    'appleStandHours': 'n',
+    'appleStandHoursGoal': 'n',
+}
+
+WORKOUT_FIELDS = {
+    'sourceName': 's',
+    'sourceVersion': 's',
+    'device': 's',
+    'creationDate': 'd',
+    'startDate': 'd',
+    'endDate': 'd',
+    'workoutActivityType': 's',
+    'duration': 'n',
+    'durationUnit': 's',
+    'totalDistance': 'n',
+    'totalDistanceUnit': 's',
+    'totalEnergyBurned': 'n',
+    'totalEnergyBurnedUnit': 's',
+}
 
 FIELDS = {
     'Record': RECORD_FIELDS,
@@ -63,8 +60,12 @@ FIELDS = {
 
 
 PREFIX_RE = re.compile('^HK.*TypeIdentifier(.+)$')
+_abbr = PREFIX_RE.match
 ABBREVIATE = True
 VERBOSE = True
+READ_BUFFER_SIZE = 1 << 16  # bytes of export.xml fed to the parser at once
+WRITE_BUFFER_SIZE = 1 << 20  # bytes buffered per CSV file before writing
+PARTIAL_SUFFIX = '.part'  # CSVs are named this until extract() succeeds
 
 def format_freqs(counter):
     """
@@ -74,6 +75,25 @@ def format_freqs(counter):
                      for tag in sorted(counter.keys()))
 
 
+def escape(value):
+    """
+    Quote a string for a CSV file, escaping double quotes and backslashes.
+    None maps to empty.
+    """
+    if value is None:
+        return ''
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+# Most string fields (sourceName, unit, ...) take a handful of distinct
+# values across an export, so their escaped form is cached rather than
+# rebuilt for every record. Fields in UNCACHED_FIELDS are mostly distinct
+# (device embeds a per-object pointer, <<HKDevice: 0x...>, ...>), so
+# caching them would only cost time and memory.
+quote = lru_cache(maxsize=1 << 10)(escape)
+UNCACHED_FIELDS = {'device'}
+
+
 def format_value(value, datatype):
     """
     Format a value for a CSV file, escaping double quotes and backslashes.
@@ -86,19 +106,73 @@ def format_value(value, datatype):
     if value is None:
         return ''
     elif datatype == 's':  # string
-        return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+        return quote(value)
     elif datatype in ('n', 'd'):  # number or date
         return value
     else:
         raise KeyError('Unexpected format value: %s' % datatype)
 
 
-def abbreviate(s, enabled=ABBREVIATE):
+def make_formatter(tag, fields, fixed=None):
     """
-    Abbreviate particularly verbose strings based on a regular expression
+    Build a function that formats a node with the given fields as a CSV
+    line, with the same output as applying format_value to each field.
+    The datatype of every field is known up front, so the choice of
+    formatting is made once, when the function's source is generated,
+    rather than for every field of every record.
+    fixed optionally maps fields to values shared by every node the
+    function will see (e.g. the type of a Record); those are formatted
+    once here and not read from the node at all.
     """
-    m = re.match(PREFIX_RE, s)
-    return m.group(1) if enabled and m else s
+    fixed = fixed or {}
+    namespace = {'escape': escape, 'quote': quote}
+    parts = []
+    for (field, datatype) in fields.items():
+        if field in fixed:
+            constant = 'fixed_%s' % field
+            namespace[constant] = format_value(fixed[field], datatype)
+            parts.append('{%s}' % constant)
+        elif datatype == 's' and field in UNCACHED_FIELDS:
+            parts.append('{escape(get(%r))}' % field)
+        elif datatype == 's':  # string
+            parts.append('{quote(get(%r))}' % field)
+        elif datatype in ('n', 'd'):  # number or date
+            parts.append("{get(%r) or ''}" % field)
+        else:
+            raise KeyError('Unexpected format value: %s' % datatype)
+    name = 'format_%s' % tag
+    source = ('def %s(node):\n'
+              '    get = node.get\n'
+              '    return f"%s\\n"\n' % (name, ','.join(parts)))
+    exec(source, namespace)
+    return namespace[name]
+
+
+# Record kinds each get their own formatter, with the type fixed, when
+# their file is opened (see HealthDataExtractor.open_for_writing).
+FORMATTERS = {tag: make_formatter(tag, FIELDS[tag])
+              for tag in ('ActivitySummary', 'Workout')}
+
+
+class TopLevelNodes(object):
+    """
+    XMLParser target that collects the top-level nodes of the export,
+    without their children, as ElementTree Elements in self.nodes.
+    """
+    def __init__(self):
+        self.depth = 0
+        self.nodes = []
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.depth == 2:
+            self.nodes.append(ElementTree.Element(tag, attrib))
+
+    def end(self, tag):
+        self.depth -= 1
+
+    def close(self):
+        return None
 
 
 class HealthDataExtractor(object):
@@ -111,37 +185,65 @@ class HealthDataExtractor(object):
         Writes a CSV file for each record type found, in the same
         directory as the input export.xml. Reports each file written
         unless verbose has been set to False.
+    The export is streamed rather than loaded whole, so memory use stays
+    flat however large export.xml is; abbreviation, counting and writing
+    all happen in a single pass in extract(). report_stats() reuses the
+    counts from that pass, so call it after extract(): called first, or
+    after a quiet (verbose=False) extract(), which skips the tag and
+    field counts, it has to parse the export again itself.
     """
     def __init__(self, path, verbose=VERBOSE):
         self.in_path = path
         self.verbose = verbose
         self.directory = os.path.abspath(os.path.split(path)[0])
-        with open(path) as f:
-            self.report('Reading data from %s . . . ' % path, end='')
-            self.data = ElementTree.parse(f)
-            self.report('done')
-        self.root = self.data._root
-        self.nodes = list(self.root)
-        self.n_nodes = len(self.nodes)
-        self.abbreviate_types()
-        self.collect_stats()
+        self.handles = {}
+        self.writers = {}
+        self.paths = []
+        self.reset_stats()
 
     def report(self, msg, end='\n'):
         if self.verbose:
             print(msg, end = end)
             sys.stdout.flush()
 
-    def count_tags_and_fields(self):
+    def iter_nodes(self):
+        """
+        Yield the top-level nodes of the export one at a time. Nodes
+        nested inside them (e.g. a Record in a Correlation) are skipped.
+        The export is fed to ElementTree's C XMLParser, which calls back
+        a TopLevelNodes target for each element, rather than going through
+        iterparse's Python-level event loop. Only the nodes we want are
+        built, and each is discarded as soon as the caller has finished
+        with it, so the tree is never held in memory.
+        """
+        self.report('Reading data from %s . . .' % self.in_path)
+        target = TopLevelNodes()
+        parser = ElementTree.XMLParser(target=target)
+        with open(self.in_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(READ_BUFFER_SIZE), b''):
+                parser.feed(chunk)
+                for node in target.nodes:
+                    yield node
+                target.nodes.clear()
+        parser.close()
+        self.report('done')
+
+    def reset_stats(self):
+        self.n_nodes = 0
         self.tags = Counter()
         self.fields = Counter()
-        for record in self.nodes:
-            self.tags[record.tag] += 1
-            for k in record.keys():
-                self.fields[k] += 1
+        self.record_types = Counter()
+        self.other_types = Counter()
+        self.stats_collected = False
 
-    def count_record_types(self):
+    def process(self, write=True, count_fields=True):
         """
-        Counts occurrences of each type of (conceptual) "record" in the data.
+        Make a single pass over the export. Each node is touched once:
+        its type is abbreviated, it is counted, and (if write is set) it
+        is written to the CSV file for its kind.
+        Tags and fields are only counted, and unexpected nodes only
+        reported, if count_fields is set; they are needed by
+        report_stats() and nothing else.
         In the case of nodes of type 'Record', this counts the number of
         occurrences of each 'type' or record in self.record_types.
         In the case of nodes of type 'ActivitySummary' and 'Workout',
@@ -152,91 +254,123 @@ class HealthDataExtractor(object):
         all Workout entries to a single file, and all ActivitySummary
         entries to another single file.
         """
+        self.n_nodes = 0
         self.record_types = Counter()
         self.other_types = Counter()
-        for record in self.nodes:
-            if record.tag == 'Record':
-                self.record_types[record.attrib['type']] += 1
-            elif record.tag in ('ActivitySummary', 'Workout'):
-                self.other_types[record.tag] += 1
-            elif record.tag in ('Export', 'Me'):
-                pass
+        if count_fields:
+            self.tags = Counter()
+            self.fields = Counter()
+        # Bind everything the loop touches to locals; it runs once per node.
+        tags, fields = self.tags, self.fields
+        record_types, other_types = self.record_types, self.other_types
+        count_keys = fields.update
+        get_writer = self.writers.get
+        open_for_writing = self.open_for_writing
+        abbr = _abbr if ABBREVIATE else None
+        n_nodes = 0
+        for node in self.iter_nodes():
+            tag = node.tag
+            n_nodes += 1
+            if count_fields:
+                tags[tag] += 1
+                count_keys(node.keys())
+            if tag == 'Record':
+                kind = node.get('type')
+                if abbr:  # shorten types by removing boilerplate (PREFIX_RE)
+                    m = abbr(kind)
+                    if m:
+                        kind = m.group(1)
+                record_types[kind] += 1
+            elif tag in FIELDS:
+                kind = tag
+                other_types[kind] += 1
             else:
-                self.report('Unexpected node of type %s.' % record.tag)
-
-    def collect_stats(self):
-        self.count_record_types()
-        self.count_tags_and_fields()
-
-    def open_for_writing(self):
-        self.handles = {}
-        self.paths = []
-        for kind in (list(self.record_types) + list(self.other_types)):
-            path = os.path.join(self.directory, '%s.csv' % abbreviate(kind))
-            f = open(path, 'w')
-            headerType = (kind if kind in ('Workout', 'ActivitySummary')
-                          else 'Record')
-            f.write(','.join(FIELDS[headerType].keys()) + '\n')
-            self.handles[kind] = f
-            self.report('Opening %s for writing' % path)
-
-    def abbreviate_types(self):
+                if count_fields and tag not in ('Export', 'Me'):
+                    self.report('Unexpected node of type %s.' % tag)
+                continue
+            if write:
+                writer, formatter = (get_writer(kind)
+                                     or open_for_writing(kind))
+                writer(formatter(node))
+        self.n_nodes = n_nodes
+        if count_fields:
+            self.stats_collected = True
+
+    def open_for_writing(self, kind):
+        path = os.path.join(self.directory, '%s.csv' % kind)
+        f = open(path + PARTIAL_SUFFIX, 'w', buffering=WRITE_BUFFER_SIZE)
+        headerType = (kind if kind in ('Workout', 'ActivitySummary')
+                      else 'Record')
+        f.write(','.join(FIELDS[headerType].keys()) + '\n')
+        if headerType == 'Record':
+            formatter = make_formatter(headerType, RECORD_FIELDS,
+                                       fixed={'type': kind})
+        else:
+            formatter = FORMATTERS[headerType]
+        self.handles[kind] = f
+        self.writers[kind] = (f.write, formatter)
+        self.report('Opening %s for writing' % path)
+        return self.writers[kind]
+
+    def close_files(self, keep=True):
         """
-        Shorten types by removing common boilerplate text.
+        Close the output files. They are written under temporary names
+        and only moved into place if keep is set, so an extraction that
+        fails part way (e.g. on a truncated export.xml) leaves any earlier
+        output untouched.
         """
-        for node in self.nodes:
-            if node.tag == 'Record':
-                if 'type' in node.attrib:
-                    node.attrib['type'] = abbreviate(node.attrib['type'])
-
-    def write_records(self):
-        kinds = FIELDS.keys()
-        for node in self.nodes:
-            if node.tag in kinds:
-                attributes = node.attrib
-                kind = attributes['type'] if node.tag == 'Record' else node.tag
-                values = [format_value(attributes.get(field), datatype)
-                          for (field, datatype) in FIELDS[node.tag].items()]
-                line = ','.join(values) + '\n'
-                self.handles[kind].write(line)
-
-    def close_files(self):
         for (kind, f) in self.handles.items():
             f.close()
-            self.report('Written %s data.' % abbreviate(kind))
+            if keep:
+                os.replace(f.name, f.name[:-len(PARTIAL_SUFFIX)])
+                self.report('Written %s data.' % kind)
+            else:
+                os.remove(f.name)
+        self.handles = {}
+        self.writers = {}
 
     def extract(self):
-        self.open_for_writing()
-        self.write_records()
-        self.close_files()
+        completed = False
+        try:
+            self.process(count_fields=self.verbose
+                         and not self.stats_collected)
+            completed = True
+        finally:
+            self.close_files(keep=completed)
 
     def report_stats(self):
+        """
+        Print the tag, field and record-type counts. These come from the
+        last extract() if it collected them; otherwise this makes its own
+        counting pass over the export.
+        """
+        if not self.stats_collected:
+            self.process(write=False)
         print('\nTags:\n%s\n' % format_freqs(self.tags))
         print('Fields:\n%s\n' % format_freqs(self.fields))
         print('Record types:\n%s\n' % format_freqs(self.record_types))
 
 
 if __name__ == '__main__':
+    from icalendar import Calendar
 
     #calendar data parser
     g = open('charlesrichardsonusagmail.com.ics', 'rb')
-gcal = Calendar.from_ical(g.read())
-for component in gcal.walk():
-    if component.name == "VEVENT":
-        if component.get('summary') == 'Rest':
-            print(component.get('summary'))
-            start = (component.get('dtstart'))
-            print(start.dt)
-            end = (component.get('dtend'))
-            print(end.dt)
-            stamp = (component.get('dtstamp'))
-            print(stamp.dt)
-        g.close()
+    gcal = Calendar.from_ical(g.read())
+    g.close()
+    for component in gcal.walk():
+        if component.name == "VEVENT":
+            if component.get('summary') == 'Rest':
+                print(component.get('summary'))
+                start = (component.get('dtstart'))
+                print(start.dt)
+                end = (component.get('dtend'))
+                print(end.dt)
+                stamp = (component.get('dtstamp'))
+                print(stamp.dt)
 
     #health data parser
 
     #data = HealthDataExtractor("cameron_keene_health_data.xml")#enter file to be parsed within quotes here
-    #data.report_stats()
     #data.extract()
-
-
+    #data.report_stats()